@@ -0,0 +1,195 @@
+"""Benchmark dummy data generation for each variable of the study definitions.
+
+Every variable, and then the population, is generated with dummy_data.py
+for every patient. For each one the report records its wall time, the rows
+it returned (patients with a value set in any of its columns) and the
+peak memory allocated while generating it, measured with tracemalloc from
+a reset peak. Timings include tracemalloc's overhead, which is the same
+for both sides of a --baseline comparison. Each (study definition, size)
+pair runs in a fresh process, whose peak RSS is recorded for the run as a
+whole. Run from the repository root:
+
+    python analysis/benchmark_dummy_data.py [--sizes 50000 1000000 10000000] \\
+        [--output output/benchmark_dummy_data.json] [--baseline OLD.json] \\
+        [study_definition ...]
+
+This measures the generator, which draws each column from its
+return_expectations, not the database queries cohortextractor runs: a
+variable's cost here does not depend on its codelist or date window, so
+a covariate that is slow to extract will not show up as slow here.
+
+The report is JSON sorted by key, so reports from two commits can be
+diffed directly; with --baseline, variables that got more than
+--threshold times slower than in the baseline report are listed.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+
+analysis_dir = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_STUDIES = ["study_definition", "study_definition_flow_chart"]
+DEFAULT_SIZES = [50_000, 1_000_000, 10_000_000]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(study_name, size, seed):
+    """Time every variable of one study definition at one size."""
+    import numpy as np
+
+    import dummy_data
+    import expressions
+
+    study_kwargs = dummy_data.load_study_definition(study_name)
+    generator = dummy_data.ColumnGenerator(
+        size,
+        study_kwargs.get("index_date"),
+        study_kwargs.get("default_expectations", {}),
+        seed,
+    )
+    # The population can refer to any covariate, so it is evaluated last
+    population = study_kwargs["population"]
+    variables = dummy_data.covariates(study_kwargs) + [("population", *population)]
+
+    data = {"patient_id": np.arange(1, size + 1)}
+    results = []
+    tracemalloc.start()
+    start = time.perf_counter()
+    for name, query_type, query_args in variables:
+        tracemalloc.reset_peak()
+        allocated_before = tracemalloc.get_traced_memory()[0]
+        variable_start = time.perf_counter()
+        columns = dict(generator.columns(name, query_type, query_args, data))
+        seconds = time.perf_counter() - variable_start
+        peak_allocated = tracemalloc.get_traced_memory()[1] - allocated_before
+        data.update(columns)
+        returned = np.zeros(size, dtype=bool)
+        for values in columns.values():
+            returned |= expressions.is_true(values)
+        results.append(
+            {
+                "name": name,
+                "query_type": query_type,
+                "columns": sorted(columns),
+                "rows": int(returned.sum()),
+                "seconds": round(seconds, 4),
+                "peak_alloc_mb": round(peak_allocated / 2**20, 1),
+            }
+        )
+    tracemalloc.stop()
+    return {
+        "study_definition": study_name,
+        "size": size,
+        "seed": seed,
+        "seconds": round(time.perf_counter() - start, 4),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "variables": results,
+    }
+
+
+def run_in_subprocess(study_name, size, seed):
+    output = subprocess.run(
+        [sys.executable, __file__, "--single", study_name, str(size), str(seed)],
+        check=True,
+        stdout=subprocess.PIPE,
+        text=True,
+    ).stdout
+    return json.loads(output)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            cwd=analysis_dir,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def regressions(report, baseline, threshold):
+    """Yield (study, size, variable, old seconds, new seconds) for variables
+    more than threshold times slower than in the baseline."""
+    old_times = {
+        (r["study_definition"], r["size"], v["name"]): v["seconds"]
+        for r in baseline["runs"]
+        for v in r["variables"]
+    }
+    for r in report["runs"]:
+        for v in r["variables"]:
+            old = old_times.get((r["study_definition"], r["size"], v["name"]))
+            # Ignore variables too quick to time reliably
+            if old is not None and max(old, v["seconds"]) >= 0.05:
+                if v["seconds"] > old * threshold:
+                    yield r["study_definition"], r["size"], v["name"], old, v["seconds"]
+
+
+def main(study_names, sizes, seed, output, baseline, threshold):
+    report = {
+        "commit": git_commit(),
+        "created_at": f"{datetime.datetime.utcnow():%Y-%m-%dT%H:%M:%S}Z",
+        "python": platform.python_version(),
+        "runs": [],
+    }
+    for study_name in study_names:
+        for size in sizes:
+            result = run_in_subprocess(study_name, size, seed)
+            report["runs"].append(result)
+            print(
+                f"{study_name:<30} {size:>10} rows  {result['seconds']:>8.2f}s  "
+                f"{result['peak_rss_mb']:>8.0f} MB"
+            )
+
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print(f"Report written to {output}")
+
+    if baseline:
+        with open(baseline) as f:
+            slower = list(regressions(report, json.load(f), threshold))
+        for study_name, size, name, old, new in slower:
+            print(f"SLOWER {study_name} {size} {name}: {old:.3f}s -> {new:.3f}s")
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--single"]:
+        study_name, size, seed = sys.argv[2], int(sys.argv[3]), int(sys.argv[4])
+        json.dump(run(study_name, size, seed), sys.stdout)
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("study_definitions", nargs="*")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="output/benchmark_dummy_data.json")
+    parser.add_argument("--baseline", help="earlier report to compare against")
+    parser.add_argument("--threshold", type=float, default=1.5)
+    args = parser.parse_args()
+    sys.exit(
+        main(
+            args.study_definitions or DEFAULT_STUDIES,
+            args.sizes,
+            args.seed,
+            args.output,
+            args.baseline,
+            args.threshold,
+        )
+    )
@@ -0,0 +1,86 @@
+"""Benchmark compiled categorised_as/satisfying evaluation in dummy data.
+
+For each patients.categorised_as and patients.satisfying variable in the
+study definitions (the population included), dummy input columns are
+generated and the compiled (column) evaluator is timed on --size rows.
+The first --rowwise-size rows are also evaluated with the in-tree row by
+row reference (expressions.categorise_row) and the two results are checked
+to agree. The reference is not what cohortextractor runs, so its timing is
+shown for scale only. Throughput is reported as seconds per million rows.
+Run from the repository root:
+
+    python analysis/benchmark_expressions.py [--size N] [--rowwise-size N] \\
+        [study_definition ...]
+"""
+import argparse
+import time
+
+import numpy as np
+
+import dummy_data
+import expressions
+
+
+def expression_variables(study_kwargs):
+    variables = dummy_data.covariates(study_kwargs)
+    if "population" in study_kwargs:
+        variables.append(("population", *study_kwargs["population"]))
+    for name, query_type, query_args in variables:
+        if query_type == "categorised_as":
+            yield name, query_args, query_args["category_definitions"]
+        elif query_type == "satisfying":
+            yield name, query_args, {"1": query_args["expression"], "0": "DEFAULT"}
+
+
+def to_rows(inputs, names, size):
+    values = {name: np.asarray(inputs[name][:size]).tolist() for name in names}
+    return [dict(zip(values, row)) for row in zip(*values.values())]
+
+
+def benchmark(study_name, size, rowwise_size, seed):
+    study_kwargs = dummy_data.load_study_definition(study_name)
+    data = dummy_data.generate(study_kwargs, size, seed=seed)
+    generator = dummy_data.ColumnGenerator(
+        size,
+        study_kwargs.get("index_date"),
+        study_kwargs.get("default_expectations", {}),
+        seed,
+    )
+
+    for name, query_args, definitions in expression_variables(study_kwargs):
+        inputs = generator.expression_inputs(definitions.values(), query_args, data)
+        rules, default = expressions.category_rules(definitions)
+        used = set().union(*(expressions.columns_used(tree) for _, tree in rules))
+
+        start = time.perf_counter()
+        compiled = expressions.compile_categories(definitions)(inputs, size)
+        compiled_time = time.perf_counter() - start
+
+        rows = to_rows(inputs, used, rowwise_size)
+        start = time.perf_counter()
+        rowwise = [expressions.categorise_row(rules, default, row) for row in rows]
+        rowwise_time = time.perf_counter() - start
+
+        assert list(compiled[:rowwise_size]) == rowwise, name
+        compiled_rate = compiled_time / size * 1e6
+        rowwise_rate = rowwise_time / rowwise_size * 1e6
+        print(
+            f"{study_name:<30} {name:<22} {compiled_rate:>10.3f} "
+            f"{rowwise_rate:>10.3f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("study_definitions", nargs="*")
+    parser.add_argument("--size", type=int, default=1_000_000)
+    parser.add_argument("--rowwise-size", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(
+        f"{'study definition':<30} {'variable':<22} {'compiled':>10} "
+        f"{'reference':>10}   (seconds per million rows)"
+    )
+    for study_name in args.study_definitions or ["study_definition"]:
+        benchmark(study_name, args.size, min(args.rowwise_size, args.size), args.seed)
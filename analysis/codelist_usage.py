@@ -0,0 +1,47 @@
+"""Report which codelists each study definition reads in.
+
+Codelists in codelists.py are only parsed when a study definition imports
+them, so importing each study definition on its own shows exactly which
+codelists it touches. Run from the repository root:
+
+    python analysis/codelist_usage.py [study_definition ...]
+
+With no arguments every analysis/study_definition*.py is reported.
+"""
+import glob
+import importlib
+import os
+import sys
+
+
+analysis_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def codelists_used(study_name):
+    # Import a fresh copy of codelists.py for each study definition, so that
+    # codelists loaded by one are not counted against the next
+    for module in ("codelists", study_name):
+        sys.modules.pop(module, None)
+    importlib.import_module(study_name)
+    codelists = sys.modules["codelists"]
+    return codelists.loaded_codelists, codelists.CSV_CODELISTS
+
+
+def main(study_names):
+    if analysis_dir not in sys.path:
+        sys.path.insert(0, analysis_dir)
+    if not study_names:
+        study_names = sorted(
+            os.path.basename(path)[:-3]
+            for path in glob.glob(os.path.join(analysis_dir, "study_definition*.py"))
+        )
+
+    for study_name in study_names:
+        loaded, available = codelists_used(study_name)
+        print(f"{study_name}: {len(loaded)} of {len(available)} csv codelists")
+        for name in loaded:
+            print(f"    {name:<35} {available[name]['filename']}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,44 +1,99 @@
+import atexit
+import hashlib
+import os
+import pickle
+
 from cohortextractor import (
     codelist,
     codelist_from_csv,
 )
 
 
-### Outcomes
+### Codelist cache
 
-# COVID death
-covid_codelist = codelist(["U071", "U072"], system="icd10")
+# Parsed codelists are kept in a single cache file, keyed by a hash of each
+# csv's contents, so a csv is only parsed again when the file itself
+# changes (reading and hashing ~40 small files is cheap; parsing them is
+# what the cache saves).
+CODELIST_CACHE = "codelists/.codelist_cache.pickle"
 
 
-### Demographics
+def _file_sha(filename):
+    try:
+        with open(filename, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
 
-# Smoking
-clear_smoking_codes = codelist_from_csv(
-    "codelists/opensafely-smoking-clear.csv",
-    system="ctv3",
-    column="CTV3Code",
-    category_column="Category",
-)
-unclear_smoking_codes = codelist_from_csv(
-    "codelists/opensafely-smoking-unclear.csv",
-    system="ctv3",
-    column="CTV3Code",
-    category_column="Category",
-)
 
-# Ethnicity
-ethnicity_codes = codelist_from_csv(
-    "codelists/opensafely-ethnicity.csv",
-    system="ctv3",
-    column="Code",
-    category_column="Grouping_6",
-)
-ethnicity_codes_16 = codelist_from_csv(
-    "codelists/opensafely-ethnicity.csv",
-    system="ctv3",
-    column="Code",
-    category_column="Grouping_16",
-)
+def _load_codelist_cache():
+    try:
+        with open(CODELIST_CACHE, "rb") as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return {}
+
+
+def _save_codelist_cache(cache):
+    # The cache is an optimisation only, so a read-only checkout just skips it
+    tmp_path = f"{CODELIST_CACHE}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, CODELIST_CACHE)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+_codelist_cache = _load_codelist_cache()
+_codelist_cache_dirty = False
+
+
+def _flush_codelist_cache():
+    # Codelists are loaded one at a time as a study definition uses them,
+    # so newly parsed ones are written back together, once, at exit
+    if not _codelist_cache_dirty:
+        return
+    # Drop entries for earlier contents of any csv (or csvs since removed)
+    current_shas = {}
+    for key in list(_codelist_cache):
+        filename, sha = key[:2]
+        if filename not in current_shas:
+            current_shas[filename] = _file_sha(filename)
+        if current_shas[filename] != sha:
+            del _codelist_cache[key]
+    _save_codelist_cache(_codelist_cache)
+
+
+atexit.register(_flush_codelist_cache)
+
+
+def _codelist_from_csv(filename, system, column, category_column=None):
+    sha = _file_sha(filename)
+    if sha is None:
+        return codelist_from_csv(
+            filename, system=system, column=column, category_column=category_column
+        )
+
+    key = (filename, sha, system, column, category_column)
+    codes = _codelist_cache.get(key)
+    if codes is None:
+        codes = list(
+            codelist_from_csv(
+                filename, system=system, column=column, category_column=category_column
+            )
+        )
+        _codelist_cache[key] = codes
+        global _codelist_cache_dirty
+        _codelist_cache_dirty = True
+    return codelist(codes, system=system)
+
+
+### Outcomes
+
+# COVID death
+covid_codelist = codelist(["U071", "U072"], system="icd10")
 
 
 ### Clinical measurements
@@ -50,201 +105,264 @@ hba1c_new_codes = codelist(["XaPbt", "Xaeze", "Xaezd"], system="ctv3")
 hba1c_old_codes = codelist(["X772q", "XaERo", "XaERp"], system="ctv3")
 
 
-### Comorbidities
+### Codelists from csv files
 
-# Respiratory
-asthma_codes = codelist_from_csv(
-    "codelists/opensafely-asthma-diagnosis.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-pred_codes = codelist_from_csv(
-    "codelists/opensafely-asthma-oral-prednisolone-medication.csv",
-    system="snomed",
-    column="snomed_id",
-)
-cf_codes = codelist_from_csv(
-    "codelists/opensafely-cystic-fibrosis.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-other_respiratory_codes = codelist_from_csv(
-    "codelists/opensafely-other-chronic-respiratory-disease.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
+# These are only parsed when a study definition first uses them (see
+# __getattr__ below), so import the codelists needed by name rather than
+# with "from codelists import *", which loads all of them.
+CSV_CODELISTS = {
+    ### Demographics
 
-# Cardiac
-chronic_cardiac_disease_codes = codelist_from_csv(
-    "codelists/opensafely-chronic-cardiac-disease.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-diabetes_codes = codelist_from_csv(
-    "codelists/opensafely-diabetes.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-hypertension_codes = codelist_from_csv(
-    "codelists/opensafely-hypertension.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-af_codes = codelist_from_csv(
-    "codelists/opensafely-atrial-fibrillation-or-flutter.csv",
-    system="ctv3",
-    column="CTV3Code",
-)
-dvt_pe_codes = codelist_from_csv(
-    "codelists/opensafely-venous-thromboembolic-disease.csv",
-    system="ctv3",
-    column="CTV3Code",
-)
-pad_surg_codes = codelist_from_csv(
-    "codelists/opensafely-surgery-for-peripheral-artery-disease.csv",
-    system="ctv3",
-    column="CTV3Code",
-)
-amputate_codes = codelist_from_csv(
-    "codelists/opensafely-amputation-of-lower-limb.csv",
-    system="ctv3",
-    column="CTV3Code",
-)
+    # Smoking
+    "clear_smoking_codes": dict(
+        filename="codelists/opensafely-smoking-clear.csv",
+        system="ctv3",
+        column="CTV3Code",
+        category_column="Category",
+    ),
+    "unclear_smoking_codes": dict(
+        filename="codelists/opensafely-smoking-unclear.csv",
+        system="ctv3",
+        column="CTV3Code",
+        category_column="Category",
+    ),
 
-# Neurological
-stroke = codelist_from_csv(
-    "codelists/opensafely-stroke-updated.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-dementia = codelist_from_csv(
-    "codelists/opensafely-dementia-complete.csv",
-    system="ctv3",
-    column="code",
-)
-other_neuro = codelist_from_csv(
-    "codelists/opensafely-other-neurological-conditions.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-tia = codelist_from_csv(
-    "codelists/opensafely-transient-ischaemic-attack.csv",
-    system="ctv3",
-    column="code",
-)
-# Cancer
-lung_cancer_codes = codelist_from_csv(
-    "codelists/opensafely-lung-cancer.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-haem_cancer_codes = codelist_from_csv(
-    "codelists/opensafely-haematological-cancer.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-other_cancer_codes = codelist_from_csv(
-    "codelists/opensafely-cancer-excluding-lung-and-haematological.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
+    # Ethnicity
+    "ethnicity_codes": dict(
+        filename="codelists/opensafely-ethnicity.csv",
+        system="ctv3",
+        column="Code",
+        category_column="Grouping_6",
+    ),
+    "ethnicity_codes_16": dict(
+        filename="codelists/opensafely-ethnicity.csv",
+        system="ctv3",
+        column="Code",
+        category_column="Grouping_16",
+    ),
 
+    ### Comorbidities
 
-# Liver and kidney and transplant
-chronic_liver_disease_codes = codelist_from_csv(
-    "codelists/opensafely-chronic-liver-disease.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-transplant_kidney_codes = codelist_from_csv(
-    "codelists/opensafely-kidney-transplant.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-transplant_notkidney_codes = codelist_from_csv(
-    "codelists/opensafely-other-organ-transplant.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-dialysis_codes = codelist_from_csv(
-    "codelists/opensafely-dialysis.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
+    # Respiratory
+    "asthma_codes": dict(
+        filename="codelists/opensafely-asthma-diagnosis.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "pred_codes": dict(
+        filename="codelists/opensafely-asthma-oral-prednisolone-medication.csv",
+        system="snomed",
+        column="snomed_id",
+    ),
+    "cf_codes": dict(
+        filename="codelists/opensafely-cystic-fibrosis.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "other_respiratory_codes": dict(
+        filename="codelists/opensafely-other-chronic-respiratory-disease.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
 
+    # Cardiac
+    "chronic_cardiac_disease_codes": dict(
+        filename="codelists/opensafely-chronic-cardiac-disease.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "diabetes_codes": dict(
+        filename="codelists/opensafely-diabetes.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "hypertension_codes": dict(
+        filename="codelists/opensafely-hypertension.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "af_codes": dict(
+        filename="codelists/opensafely-atrial-fibrillation-or-flutter.csv",
+        system="ctv3",
+        column="CTV3Code",
+    ),
+    "dvt_pe_codes": dict(
+        filename="codelists/opensafely-venous-thromboembolic-disease.csv",
+        system="ctv3",
+        column="CTV3Code",
+    ),
+    "pad_surg_codes": dict(
+        filename="codelists/opensafely-surgery-for-peripheral-artery-disease.csv",
+        system="ctv3",
+        column="CTV3Code",
+    ),
+    "amputate_codes": dict(
+        filename="codelists/opensafely-amputation-of-lower-limb.csv",
+        system="ctv3",
+        column="CTV3Code",
+    ),
 
-# Immunosuppression
-hiv_codes = codelist_from_csv(
-    "codelists/opensafely-hiv.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-aplastic_codes = codelist_from_csv(
-    "codelists/opensafely-aplastic-anaemia.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-temp_immune_codes = codelist_from_csv(
-    "codelists/opensafely-temporary-immunosuppression.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-permanent_immune_codes = codelist_from_csv(
-    "codelists/opensafely-permanent-immunosuppression.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-spleen_codes = codelist_from_csv(
-    "codelists/opensafely-asplenia.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-sickle_cell_codes = codelist_from_csv(
-    "codelists/opensafely-sickle-cell-disease.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-ra_sle_psoriasis_codes = codelist_from_csv(
-    "codelists/opensafely-ra-sle-psoriasis.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-inflammatory_bowel_disease_codes = codelist_from_csv(
-    "codelists/opensafely-inflammatory-bowel-disease.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
+    # Neurological
+    "stroke": dict(
+        filename="codelists/opensafely-stroke-updated.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "dementia": dict(
+        filename="codelists/opensafely-dementia-complete.csv",
+        system="ctv3",
+        column="code",
+    ),
+    "other_neuro": dict(
+        filename="codelists/opensafely-other-neurological-conditions.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "tia": dict(
+        filename="codelists/opensafely-transient-ischaemic-attack.csv",
+        system="ctv3",
+        column="code",
+    ),
 
-# Frailty
-fracture_codes = codelist_from_csv(
-    "codelists/opensafely-fragility.csv",
-    system="ctv3",
-    column="CTV3Code",
-)
+    # Cancer
+    "lung_cancer_codes": dict(
+        filename="codelists/opensafely-lung-cancer.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "haem_cancer_codes": dict(
+        filename="codelists/opensafely-haematological-cancer.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "other_cancer_codes": dict(
+        filename="codelists/opensafely-cancer-excluding-lung-and-haematological.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
 
-# Mental illness, learning disability, Down's syndrome and Cerebral Palsy
-smi_codes = codelist_from_csv(
-    "codelists/opensafely-psychosis-schizophrenia-bipolar-affective-disease.csv",
-    system="ctv3",
-    column="CTV3Code",
-)
-ldr_codes = codelist_from_csv(
-    "codelists/opensafely-learning-disabilities.csv",
-    system="ctv3",
-    column="CTV3Code",
-)
-ld_profound_codes = codelist_from_csv(
-    "codelists/opensafely-severe-and-profound-learning-disability-flags.csv",
-    system="ctv3",
-    column="code",
-)
-ds_codes = codelist_from_csv(
-    "codelists/opensafely-down-syndrome.csv",
-    system="ctv3",
-    column="code",
-)
-cp_codes = codelist_from_csv(
-    "codelists/opensafely-cerebral-palsy.csv",
-    system="ctv3",
-    column="code",
-)
+    # Liver and kidney and transplant
+    "chronic_liver_disease_codes": dict(
+        filename="codelists/opensafely-chronic-liver-disease.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "transplant_kidney_codes": dict(
+        filename="codelists/opensafely-kidney-transplant.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "transplant_notkidney_codes": dict(
+        filename="codelists/opensafely-other-organ-transplant.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "dialysis_codes": dict(
+        filename="codelists/opensafely-dialysis.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+
+    # Immunosuppression
+    "hiv_codes": dict(
+        filename="codelists/opensafely-hiv.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "aplastic_codes": dict(
+        filename="codelists/opensafely-aplastic-anaemia.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "temp_immune_codes": dict(
+        filename="codelists/opensafely-temporary-immunosuppression.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "permanent_immune_codes": dict(
+        filename="codelists/opensafely-permanent-immunosuppression.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "spleen_codes": dict(
+        filename="codelists/opensafely-asplenia.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "sickle_cell_codes": dict(
+        filename="codelists/opensafely-sickle-cell-disease.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "ra_sle_psoriasis_codes": dict(
+        filename="codelists/opensafely-ra-sle-psoriasis.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "inflammatory_bowel_disease_codes": dict(
+        filename="codelists/opensafely-inflammatory-bowel-disease.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+
+    # Frailty
+    "fracture_codes": dict(
+        filename="codelists/opensafely-fragility.csv",
+        system="ctv3",
+        column="CTV3Code",
+    ),
+
+    # Mental illness, learning disability, Down's syndrome and Cerebral Palsy
+    "smi_codes": dict(
+        filename="codelists/opensafely-psychosis-schizophrenia-bipolar-affective-disease.csv",
+        system="ctv3",
+        column="CTV3Code",
+    ),
+    "ldr_codes": dict(
+        filename="codelists/opensafely-learning-disabilities.csv",
+        system="ctv3",
+        column="CTV3Code",
+    ),
+    "ld_profound_codes": dict(
+        filename="codelists/opensafely-severe-and-profound-learning-disability-flags.csv",
+        system="ctv3",
+        column="code",
+    ),
+    "ds_codes": dict(
+        filename="codelists/opensafely-down-syndrome.csv",
+        system="ctv3",
+        column="code",
+    ),
+    "cp_codes": dict(
+        filename="codelists/opensafely-cerebral-palsy.csv",
+        system="ctv3",
+        column="code",
+    ),
+}
+
+# Names of the csv codelists loaded so far, in the order they were used
+loaded_codelists = []
+
+
+def __getattr__(name):
+    if name not in CSV_CODELISTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    codes = _codelist_from_csv(**CSV_CODELISTS[name])
+    globals()[name] = codes
+    loaded_codelists.append(name)
+    return codes
+
+
+def __dir__():
+    return sorted(set(globals()) | set(CSV_CODELISTS))
+
+
+__all__ = [
+    "covid_codelist",
+    "systolic_blood_pressure_codes",
+    "diastolic_blood_pressure_codes",
+    "creatinine_codes",
+    "hba1c_new_codes",
+    "hba1c_old_codes",
+    *CSV_CODELISTS,
+]
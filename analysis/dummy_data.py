@@ -0,0 +1,291 @@
+"""Generate dummy data for a study definition from its return_expectations.
+
+Every column is built in one go with NumPy from a seeded generator, with
+no per-patient loops, so dummy cohorts of millions of rows can be made for
+load testing. The output can be passed to cohortextractor with
+--dummy-data-file. Run from the repository root:
+
+    python analysis/dummy_data.py study_definition --size 10000000 \\
+        --index-date 2020-03-01 --output output/dummy_input.csv
+
+The file type (csv, csv.gz, dta or feather) follows the output extension.
+
+Variables defined by patients.categorised_as and patients.satisfying are
+computed from the columns they refer to (see expressions.py), so they are
+consistent with them, e.g. ethnicity with ethnicity_16.
+"""
+import argparse
+import datetime
+import importlib
+import os
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+
+import expressions
+
+
+analysis_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Query types that return a date unless asked for something else
+DATE_QUERIES = {
+    "died_from_any_cause",
+    "admitted_to_hospital",
+    "with_test_result_in_sgss",
+}
+
+# Rough shape of the population age distribution (weight per year of age)
+POPULATION_AGE_WEIGHTS = np.concatenate(
+    [
+        np.full(20, 1.2),
+        np.full(45, 1.35),
+        np.full(15, 1.1),
+        np.linspace(0.9, 0.05, 26),
+    ]
+)
+
+
+def load_study_definition(study_name):
+    """Return the keyword arguments a study definition passes to
+    StudyDefinition, without building the study itself."""
+    import cohortextractor
+
+    captured = {}
+
+    def capture_study_definition(**kwargs):
+        captured.update(kwargs)
+        return kwargs
+
+    if analysis_dir not in sys.path:
+        sys.path.insert(0, analysis_dir)
+    sys.modules.pop(study_name, None)
+    study_definition = cohortextractor.StudyDefinition
+    cohortextractor.StudyDefinition = capture_study_definition
+    try:
+        importlib.import_module(study_name)
+    finally:
+        cohortextractor.StudyDefinition = study_definition
+    return captured
+
+
+def covariates(study_kwargs):
+    """The (name, query_type, query_args) of each output column."""
+    ignore = {"index_date", "default_expectations", "population"}
+    return [
+        (name, definition[0], definition[1])
+        for name, definition in study_kwargs.items()
+        if name not in ignore
+    ]
+
+
+def parse_date(value, index_date):
+    if value == "today":
+        return np.datetime64(datetime.date.today(), "D")
+    match = re.fullmatch(
+        r"index_date(?:\s*([+-])\s*(\d+)\s*(day|month|year)s?)?", value.strip()
+    )
+    if match is None:
+        return np.datetime64(value, "D")
+    date = np.datetime64(index_date, "D")
+    if match.group(1):
+        days = int(match.group(2)) * {"day": 1, "month": 30.44, "year": 365.25}[
+            match.group(3)
+        ]
+        date += np.timedelta64(round(days) * (1 if match.group(1) == "+" else -1), "D")
+    return date
+
+
+def merged_expectations(defaults, expectations):
+    expectations = expectations or {}
+    merged = {**defaults, **expectations}
+    if "date" in expectations:
+        merged["date"] = {**defaults.get("date", {}), **expectations["date"]}
+    return merged
+
+
+def categorical(codes, labels):
+    # Formatting can map several codes to one label (e.g. days to months)
+    labels, inverse = np.unique(np.asarray(labels, dtype=str), return_inverse=True)
+    return pd.Categorical.from_codes(inverse[codes], labels)
+
+
+class ColumnGenerator:
+    def __init__(self, size, index_date, default_expectations, seed):
+        self.size = size
+        self.index_date = index_date
+        self.defaults = default_expectations
+        self.rng = np.random.default_rng(seed)
+
+    def incidence_mask(self, expectations):
+        if expectations.get("rate") == "universal":
+            return np.ones(self.size, dtype=bool)
+        return self.rng.random(self.size) < expectations.get("incidence", 1.0)
+
+    def dates(self, expectations, mask, date_format):
+        spec = expectations.get("date", {})
+        earliest = parse_date(spec.get("earliest", "1900-01-01"), self.index_date)
+        latest = parse_date(spec.get("latest", "today"), self.index_date)
+        span = max(int((latest - earliest).astype(int)), 0) + 1
+        u = self.rng.random(self.size)
+        if expectations.get("rate") == "exponential_increase":
+            u = np.sqrt(u)
+        offsets = (u * span).astype(np.int64)
+        offsets[~mask] = span
+
+        # Each day in the range is formatted once and stored as a category,
+        # which keeps large cohorts to a few bytes per value
+        unit = {"YYYY": "Y", "YYYY-MM": "M", "YYYY-MM-DD": "D"}[date_format]
+        days = earliest + np.arange(span).astype("timedelta64[D]")
+        labels = np.append(np.datetime_as_string(days, unit=unit), "")
+        return categorical(offsets, labels)
+
+    def categories(self, expectations, mask):
+        ratios = expectations["category"]["ratios"]
+        p = np.array(list(ratios.values()), dtype=float)
+        codes = self.rng.choice(len(p), size=self.size, p=p / p.sum())
+        codes[~mask] = len(p)
+        return categorical(codes, [*ratios, ""])
+
+    def numbers(self, expectations, mask, kind):
+        spec = expectations[kind]
+        if spec.get("distribution") == "population_ages":
+            p = POPULATION_AGE_WEIGHTS / POPULATION_AGE_WEIGHTS.sum()
+            values = self.rng.choice(len(p), size=self.size, p=p).astype(float)
+        else:
+            values = self.rng.normal(spec["mean"], spec["stddev"], self.size)
+        if kind == "int":
+            values = np.rint(values)
+        values[~mask] = np.nan if kind == "float" else 0
+        return values.astype(int) if kind == "int" else values
+
+    def columns(self, name, query_type, query_args, data):
+        """Yield (column name, values) for one covariate, given the columns
+        generated so far."""
+        if query_type == "categorised_as":
+            definitions = query_args["category_definitions"]
+            inputs = self.expression_inputs(definitions.values(), query_args, data)
+            yield name, expressions.compile_categories(definitions)(inputs, self.size)
+            return
+        if query_type == "satisfying":
+            expression = query_args["expression"]
+            inputs = self.expression_inputs([expression], query_args, data)
+            mask = expressions.compile_expression(expression)(inputs, self.size)
+            yield name, mask.astype(int)
+            return
+
+        expectations = merged_expectations(
+            self.defaults, query_args.get("return_expectations")
+        )
+        if query_type == "all":
+            # patients.all() has no expectations; it is true for everyone
+            expectations = {**expectations, "rate": "universal"}
+        mask = self.incidence_mask(expectations)
+        returning = query_args.get("returning") or ""
+        date_format = self.date_format(query_args)
+        returns_date = (
+            returning.startswith("date")
+            or query_args.get("return_first_date_in_period")
+            or query_args.get("return_last_date_in_period")
+            or (query_type in DATE_QUERIES and not returning.startswith("binary"))
+        )
+
+        if "category" in expectations:
+            yield name, self.categories(expectations, mask)
+        elif "int" in expectations:
+            yield name, self.numbers(expectations, mask, "int")
+        elif "float" in expectations:
+            yield name, self.numbers(expectations, mask, "float")
+        elif returns_date:
+            yield name, self.dates(expectations, mask, date_format)
+        elif returning.startswith("number_of"):
+            yield name, np.where(mask, self.rng.poisson(1.0, self.size) + 1, 0)
+        else:
+            yield name, mask.astype(int)
+
+        if query_args.get("include_date_of_match"):
+            yield f"{name}_date", self.dates(expectations, mask, date_format)
+        if query_args.get("include_measurement_date"):
+            yield f"{name}_date_measured", self.dates(expectations, mask, date_format)
+
+    def expression_inputs(self, expression_list, query_args, data):
+        """The columns an expression can refer to: those generated so far
+        plus the ones defined alongside it."""
+        trees = [
+            expressions.parse(expression)
+            for expression in expression_list
+            if expression.strip() != "DEFAULT"
+        ]
+        inputs = dict(data)
+        for name, (query_type, extra_args) in query_args.get(
+            "extra_columns", {}
+        ).items():
+            # Categories with no expectations are drawn evenly from the
+            # values the expressions test for
+            literals = dict.fromkeys(
+                str(value)
+                for tree in trees
+                for value in expressions.literals_compared_with(tree, name)
+            )
+            expectations = extra_args.get("return_expectations") or {}
+            if (
+                extra_args.get("returning") == "category"
+                and literals
+                and "category" not in expectations
+            ):
+                ratios = {value: 1 / len(literals) for value in literals}
+                expectations = {**expectations, "category": {"ratios": ratios}}
+                extra_args = {**extra_args, "return_expectations": expectations}
+            inputs.update(self.columns(name, query_type, extra_args, inputs))
+        return inputs
+
+    @staticmethod
+    def date_format(query_args):
+        if query_args.get("date_format"):
+            return query_args["date_format"]
+        if query_args.get("include_day"):
+            return "YYYY-MM-DD"
+        if query_args.get("include_month"):
+            return "YYYY-MM"
+        return "YYYY"
+
+
+def generate(study_kwargs, size, index_date=None, seed=0):
+    """Return a DataFrame of dummy data for the given StudyDefinition kwargs."""
+    index_date = index_date or study_kwargs.get("index_date")
+    generator = ColumnGenerator(
+        size, index_date, study_kwargs.get("default_expectations", {}), seed
+    )
+    data = {"patient_id": np.arange(1, size + 1)}
+    for name, query_type, query_args in covariates(study_kwargs):
+        data.update(generator.columns(name, query_type, query_args, data))
+    return pd.DataFrame(data)
+
+
+def write(df, path):
+    if path.endswith(".csv") or path.endswith(".csv.gz"):
+        df.to_csv(path, index=False)
+    elif path.endswith(".dta"):
+        # Stata would otherwise store categories as value-labelled integers
+        df = df.astype(
+            {name: str for name, dtype in df.dtypes.items() if dtype == "category"}
+        )
+        df.to_stata(path, write_index=False)
+    elif path.endswith(".feather"):
+        df.to_feather(path)
+    else:
+        raise ValueError(f"Unsupported output type: {path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("study_definition")
+    parser.add_argument("--size", type=int, default=50000)
+    parser.add_argument("--index-date")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", required=True)
+    args = parser.parse_args()
+
+    study_kwargs = load_study_definition(args.study_definition)
+    write(generate(study_kwargs, args.size, args.index_date, args.seed), args.output)
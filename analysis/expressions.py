@@ -0,0 +1,299 @@
+"""Evaluate patients.satisfying and patients.categorised_as expressions.
+
+Expressions such as
+
+    (most_recent_smoking_code = 'E' OR (
+      most_recent_smoking_code = 'N' AND ever_smoked
+    )) AND NOT smoked_last_18_months
+
+are parsed once into a tree and compiled into a function that works on
+whole columns: each comparison becomes a NumPy mask, and comparisons on
+categorical columns are made once per category rather than once per row.
+categorised_as assigns the first category whose expression matches, and
+the DEFAULT category to the rest.
+
+evaluate_row walks the same tree for a single patient; it is the
+reference the compiled version is checked (and benchmarked) against.
+"""
+import operator
+import re
+
+import numpy as np
+import pandas as pd
+
+
+TOKEN = re.compile(
+    r"""
+    (?P<number>-?\d+(?:\.\d+)?)
+    | (?P<string>'[^']*'|"[^"]*")
+    | (?P<op><=|>=|!=|=|<|>|\(|\))
+    | (?P<name>[A-Za-z_]\w*)
+    """,
+    re.VERBOSE,
+)
+KEYWORDS = {"AND", "OR", "NOT"}
+COMPARISONS = {
+    "=": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+
+def tokenise(expression):
+    tokens = []
+    pos = 0
+    while True:
+        while pos < len(expression) and expression[pos].isspace():
+            pos += 1
+        if pos == len(expression):
+            return tokens
+        match = TOKEN.match(expression, pos)
+        if match is None:
+            raise ValueError(f"Cannot parse expression at: {expression[pos:]!r}")
+        kind, text = match.lastgroup, match.group(match.lastgroup)
+        if kind == "name" and text.upper() in KEYWORDS:
+            kind, text = "keyword", text.upper()
+        elif kind == "string":
+            text = text[1:-1]
+        elif kind == "number":
+            text = float(text) if "." in text else int(text)
+        tokens.append((kind, text))
+        pos = match.end()
+
+
+class Parser:
+    """Recursive descent parser; NOT binds tighter than AND, AND than OR."""
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = tokenise(expression)
+        self.pos = 0
+
+    def parse(self):
+        tree = self.or_expression()
+        if self.pos != len(self.tokens):
+            self.error()
+        return tree
+
+    def error(self):
+        raise ValueError(f"Invalid expression: {self.expression.strip()!r}")
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def accept(self, kind, text):
+        if self.peek() == (kind, text):
+            self.pos += 1
+            return True
+        return False
+
+    def or_expression(self):
+        terms = [self.and_expression()]
+        while self.accept("keyword", "OR"):
+            terms.append(self.and_expression())
+        return terms[0] if len(terms) == 1 else ("or", terms)
+
+    def and_expression(self):
+        terms = [self.not_expression()]
+        while self.accept("keyword", "AND"):
+            terms.append(self.not_expression())
+        return terms[0] if len(terms) == 1 else ("and", terms)
+
+    def not_expression(self):
+        if self.accept("keyword", "NOT"):
+            return ("not", self.not_expression())
+        return self.comparison()
+
+    def comparison(self):
+        left = self.atom()
+        kind, text = self.peek()
+        if kind == "op" and text in COMPARISONS:
+            self.pos += 1
+            return ("compare", text, left, self.atom())
+        return left
+
+    def atom(self):
+        kind, text = self.peek()
+        self.pos += 1
+        if (kind, text) == ("op", "("):
+            tree = self.or_expression()
+            if not self.accept("op", ")"):
+                self.error()
+            return tree
+        if kind == "name":
+            return ("column", text)
+        if kind in ("string", "number"):
+            return ("value", text)
+        self.error()
+
+
+def parse(expression):
+    return Parser(expression).parse()
+
+
+def columns_used(tree):
+    if tree[0] == "column":
+        return {tree[1]}
+    if tree[0] == "value":
+        return set()
+    if tree[0] == "compare":
+        return columns_used(tree[2]) | columns_used(tree[3])
+    if tree[0] == "not":
+        return columns_used(tree[1])
+    return set().union(*map(columns_used, tree[1]))
+
+
+def literals_compared_with(tree, name):
+    """The literal values a column is compared against, in order of use."""
+    if tree[0] == "compare":
+        sides = (tree[2], tree[3])
+        if ("column", name) in sides:
+            return [side[1] for side in sides if side[0] == "value"]
+        return []
+    if tree[0] == "not":
+        return literals_compared_with(tree[1], name)
+    if tree[0] in ("and", "or"):
+        found = []
+        for term in tree[1]:
+            found += [v for v in literals_compared_with(term, name) if v not in found]
+        return found
+    return []
+
+
+def category_rules(category_definitions):
+    """Split categorised_as definitions into ([(category, tree)], default)."""
+    rules = []
+    default = ""
+    for category, expression in category_definitions.items():
+        if expression.strip() == "DEFAULT":
+            default = category
+        else:
+            rules.append((category, parse(expression)))
+    return rules, default
+
+
+# Compiled (whole column) evaluation
+
+
+def is_true(values):
+    """Truth value of a column: set, non-zero and non-empty."""
+    if isinstance(values, pd.Categorical):
+        return on_categories(values, is_true)
+    values = np.asarray(values)
+    if values.dtype == bool:
+        return values
+    if values.dtype.kind in "iuf":
+        return (values != 0) & ~np.isnan(values)
+    return (values != "") & (values != "0") & pd.notna(values)
+
+
+def on_categories(values, function):
+    # Evaluate once per distinct category, then look the result up by code
+    # (code -1, i.e. no category, picks up the appended False)
+    result = np.asarray(function(np.asarray(values.categories)), dtype=bool)
+    return np.append(result, False)[values.codes]
+
+
+def coerce_like(values, literal):
+    """Compare text with numbers numerically, as the database would."""
+    if isinstance(literal, str) or values.dtype.kind in "iufb":
+        return values
+    return pd.to_numeric(values, errors="coerce")
+
+
+def compare(op, left, right):
+    function = COMPARISONS[op]
+    if isinstance(left, pd.Categorical) and np.isscalar(right):
+        return on_categories(left, lambda c: function(coerce_like(c, right), right))
+    if isinstance(right, pd.Categorical) and np.isscalar(left):
+        return on_categories(right, lambda c: function(left, coerce_like(c, left)))
+    left, right = np.asarray(left), np.asarray(right)
+    if right.ndim == 0:
+        left = coerce_like(left, right.item())
+    elif left.ndim == 0:
+        right = coerce_like(right, left.item())
+    return np.asarray(function(left, right), dtype=bool)
+
+
+def evaluate_tree(tree, columns):
+    kind = tree[0]
+    if kind == "column":
+        values = columns[tree[1]]
+        return values.values if isinstance(values, pd.Series) else values
+    if kind == "value":
+        return tree[1]
+    if kind == "compare":
+        return compare(
+            tree[1], evaluate_tree(tree[2], columns), evaluate_tree(tree[3], columns)
+        )
+    if kind == "not":
+        return ~is_true(evaluate_tree(tree[1], columns))
+    terms = [is_true(evaluate_tree(term, columns)) for term in tree[1]]
+    return (np.logical_and if kind == "and" else np.logical_or).reduce(terms)
+
+
+def compile_expression(expression):
+    """Return a function of a dict of columns giving a boolean mask."""
+    tree = parse(expression)
+
+    def evaluate(columns, size):
+        return np.broadcast_to(is_true(evaluate_tree(tree, columns)), size)
+
+    return evaluate
+
+
+def compile_categories(category_definitions):
+    """Return a function of a dict of columns giving a pandas Categorical."""
+    rules, default = category_rules(category_definitions)
+    labels = [category for category, _ in rules] + [default]
+
+    def evaluate(columns, size):
+        codes = np.full(size, len(rules), dtype=np.int16)
+        unassigned = np.ones(size, dtype=bool)
+        for code, (_, tree) in enumerate(rules):
+            matched = unassigned & is_true(evaluate_tree(tree, columns))
+            codes[matched] = code
+            unassigned &= ~matched
+        return pd.Categorical.from_codes(codes, labels)
+
+    return evaluate
+
+
+# Row by row evaluation
+
+
+def row_value_is_true(value):
+    if value is None or value != value:
+        return False
+    return value not in (0, "", "0")
+
+
+def evaluate_row(tree, row):
+    kind = tree[0]
+    if kind == "column":
+        return row[tree[1]]
+    if kind == "value":
+        return tree[1]
+    if kind == "compare":
+        left, right = evaluate_row(tree[2], row), evaluate_row(tree[3], row)
+        if isinstance(left, str) != isinstance(right, str):
+            try:
+                left, right = float(left), float(right)
+            except ValueError:
+                return False
+        return COMPARISONS[tree[1]](left, right)
+    if kind == "not":
+        return not row_value_is_true(evaluate_row(tree[1], row))
+    if kind == "and":
+        return all(row_value_is_true(evaluate_row(term, row)) for term in tree[1])
+    return any(row_value_is_true(evaluate_row(term, row)) for term in tree[1])
+
+
+def categorise_row(rules, default, row):
+    for category, tree in rules:
+        if row_value_is_true(evaluate_row(tree, row)):
+            return category
+    return default
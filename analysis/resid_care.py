@@ -0,0 +1,81 @@
+"""Derive residential care indicators from the extracted cohorts.
+
+A household is treated as residential care for the elderly if 5 or more of
+its members are aged 65 or over, and for learning disability if 5 or more
+are on the learning disability register. Patients without a household
+(household_id 0) are in neither.
+
+For each index date this reads output/input_<date>.dta in chunks of
+patients, counts members per household, then makes a second pass to flag
+each patient, and writes output/resid_care_<date>.dta (patient_id,
+resid_care_old, resid_care_ldr) for 001_clean_input_data.do to merge in.
+
+    python analysis/resid_care.py [--chunk-size N] 2020-03-01 2020-09-01
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+
+COLUMNS = ["patient_id", "household_id", "age", "ldr"]
+MIN_RESIDENTS = 5
+
+
+def read_chunks(path, chunk_size):
+    with pd.read_stata(
+        path, columns=COLUMNS, chunksize=chunk_size, convert_dates=False
+    ) as reader:
+        for chunk in reader:
+            yield chunk
+
+
+def indicators(chunk):
+    return pd.DataFrame(
+        {
+            "household_id": chunk["household_id"].fillna(0).astype(np.int64),
+            "old": (chunk["age"] >= 65).astype(np.int64),
+            "ldr": (chunk["ldr"] == 1).astype(np.int64),
+        }
+    )
+
+
+def household_counts(path, chunk_size):
+    partial_counts = [
+        indicators(chunk).groupby("household_id").sum()
+        for chunk in read_chunks(path, chunk_size)
+    ]
+    counts = pd.concat(partial_counts).groupby(level=0).sum()
+    return counts.drop(index=0, errors="ignore")
+
+
+def resid_care(path, chunk_size):
+    counts = household_counts(path, chunk_size)
+    flagged = []
+    for chunk in read_chunks(path, chunk_size):
+        members = counts.reindex(indicators(chunk)["household_id"]).fillna(0)
+        flagged.append(
+            pd.DataFrame(
+                {
+                    "patient_id": chunk["patient_id"].to_numpy(),
+                    "resid_care_old": (members["old"] >= MIN_RESIDENTS)
+                    .astype(np.int8)
+                    .to_numpy(),
+                    "resid_care_ldr": (members["ldr"] >= MIN_RESIDENTS)
+                    .astype(np.int8)
+                    .to_numpy(),
+                }
+            )
+        )
+    return pd.concat(flagged, ignore_index=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("index_dates", nargs="+")
+    parser.add_argument("--chunk-size", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    for index_date in args.index_dates:
+        flags = resid_care(f"output/input_{index_date}.dta", args.chunk_size)
+        flags.to_stata(f"output/resid_care_{index_date}.dta", write_index=False)
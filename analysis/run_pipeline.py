@@ -0,0 +1,700 @@
+"""Run the actions in project.yaml locally, in parallel where possible.
+
+The needs: of the actions form a DAG. An action is started as soon as
+everything it needs has finished and a worker is free, with at most
+--workers actions running at once and at most N actions of one image
+running at once for each --limit IMAGE=N (e.g. the number of Stata
+licence seats). When several actions are ready, those heading the longest
+remaining chains go first. Each action is run with `opensafely exec` and
+its output goes to metadata/pipeline/<action>.log; if it fails, the
+actions that need it are skipped and everything else carries on.
+
+Unless --no-cache is given, each action's outputs are stored in
+metadata/cache under a hash of its inputs: its run: line, the digest of
+the docker image it runs in (so a re-pulled :latest image counts as a
+change), the scripts it names, the files its image reads (study
+definition and codelists for cohortextractor, analysis/ado for Stata) and
+the outputs of the actions it needs. An action whose inputs are unchanged
+is not run again; its outputs are restored from the cache instead. If the
+image digest cannot be found (docker missing or the image not pulled),
+the action is run without the cache. The cache holds copies of
+the outputs, so it is as sensitive as they are and stays local.
+
+An action in project.template.yaml can be a template sweeping over a
+grid of parameters:
+
+    cox_ldnoncovid_wave{wave}:
+      matrix:
+        wave: [1, 2]
+        exposure: [ldr, ds, cp]
+      batch: exposure
+      run: stata-mp:latest analysis/AL008_cox_regression_noncovid.do {wave} {exposure}
+      ...
+
+It is expanded into one action per combination of the matrix values, with
+each {parameter} in its name, run:, needs: and outputs: filled in (YAML
+does not allow {parameter} inside [...], so needs: that use one are
+written as a "- need" list). The values of a batch: parameter are not
+swept but passed together, space separated, to a single action (here one
+per wave, run as `... 1 ldr ds cp`), so a script that takes a list can
+load its dataset once for all of them; outputs that use a batched
+parameter are repeated for each value. The job runner only reads
+project.yaml, so after editing the template regenerate it with --expand;
+the runner warns if it is out of date.
+
+Run times are kept in metadata/pipeline/timings.json. At the end, and with
+--dry-run before starting, the critical path is reported from the latest
+recorded run time of each action (cached actions included): the chain of
+needs with the longest total run time, which bounds how quickly the
+pipeline can finish however many workers it has. Run from the repository
+root:
+
+    python analysis/run_pipeline.py [--workers N] [--limit stata-mp=2] \\
+        [--dry-run] [action ...]
+    python analysis/run_pipeline.py --expand
+
+With action names, only those actions and the actions they need are run.
+"""
+import argparse
+import glob
+import hashlib
+import itertools
+import json
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+PROJECT_FILE = "project.yaml"
+TEMPLATE_FILE = "project.template.yaml"
+PLACEHOLDER = re.compile(r"\{(\w+)\}")
+GENERATED_HEADER = """\
+# Generated from project.template.yaml by
+#     python analysis/run_pipeline.py --expand
+# Edit the template and regenerate this file rather than editing it.
+
+"""
+
+LOG_DIR = os.path.join("metadata", "pipeline")
+TIMINGS_FILE = os.path.join(LOG_DIR, "timings.json")
+CACHE_DIR = os.path.join("metadata", "cache")
+IMAGE_REGISTRY = "ghcr.io/opensafely-core"
+
+# Files read by every action of an image, besides those named in run:
+IMAGE_INPUTS = {
+    "cohortextractor": ["analysis/codelists.py", "codelists/*.csv"],
+    "stata-mp": ["analysis/*.ado", "analysis/ado/*"],
+}
+
+
+def load_actions(path=TEMPLATE_FILE):
+    """Return {name: {"run": ..., "needs": [...], "outputs": [...]}} for
+    the actions in a project file, with templates expanded, in the order
+    they are defined."""
+    import yaml
+
+    with open(path) as f:
+        project = yaml.safe_load(f)
+    actions = {
+        name: {
+            "run": action["run"],
+            "needs": action["needs"],
+            "outputs": [
+                pattern
+                for outputs in action["outputs"].values()
+                for pattern in outputs.values()
+            ],
+        }
+        for name, action in expand_templates(project["actions"]).items()
+    }
+    for name, action in actions.items():
+        for need in action["needs"]:
+            if need not in actions:
+                raise ValueError(f"Action {name} needs unknown action {need}")
+    topological_order(actions)
+    return actions
+
+
+def placeholders(text):
+    return set(PLACEHOLDER.findall(str(text)))
+
+
+def substitute(text, values, template):
+    def replace(match):
+        if match.group(1) not in values:
+            raise ValueError(f"Unknown parameter {match.group(0)} in action {template}")
+        return values[match.group(1)]
+
+    return PLACEHOLDER.sub(replace, str(text))
+
+
+def expand_template(template, action):
+    """Expand an action with a matrix: into {name: action}, one action per
+    combination of the values of the parameters that are not batched."""
+    matrix = {
+        param: [str(value) for value in values]
+        for param, values in action["matrix"].items()
+    }
+    batch = action.get("batch") or []
+    if isinstance(batch, str):
+        batch = [batch]
+    for param in batch:
+        if param not in matrix:
+            raise ValueError(
+                f"Action {template} batches {param}, which is not in its matrix"
+            )
+    needs = list(action.get("needs") or [])
+    if any(placeholders(text) & set(batch) for text in [template] + needs):
+        raise ValueError(
+            f"Action {template} uses a batched parameter in its name or needs"
+        )
+
+    swept = [param for param in matrix if param not in batch]
+    batches = [
+        dict(zip(batch, values))
+        for values in itertools.product(*(matrix[param] for param in batch))
+    ]
+    expanded = {}
+    for values in itertools.product(*(matrix[param] for param in swept)):
+        values = dict(zip(swept, values))
+        name = substitute(template, values, template)
+        if name in expanded:
+            raise ValueError(
+                f"Action {template} expands to {name} more than once; its name "
+                "must use every parameter that is not batched"
+            )
+        outputs = {}
+        for level, patterns in (action.get("outputs") or {}).items():
+            outputs[level] = {}
+            for key, pattern in patterns.items():
+                batched = (placeholders(key) | placeholders(pattern)) & set(batch)
+                for batch_values in batches if batched else [{}]:
+                    output_values = {**values, **batch_values}
+                    key_name = substitute(key, output_values, template)
+                    outputs[level][key_name] = substitute(
+                        pattern, output_values, template
+                    )
+        run_values = {**values, **{param: " ".join(matrix[param]) for param in batch}}
+        expanded[name] = {
+            "run": substitute(action["run"], run_values, template),
+            "needs": [substitute(need, values, template) for need in needs],
+            "outputs": outputs,
+        }
+    return expanded
+
+
+def expand_templates(project_actions):
+    """Expand the templates among the actions of a project file, leaving
+    the other actions as they are (with needs: and outputs: filled in)."""
+    actions = {}
+    for name, action in project_actions.items():
+        if "matrix" in action:
+            expanded = expand_template(name, action)
+        else:
+            expanded = {
+                name: {
+                    "run": action["run"],
+                    "needs": list(action.get("needs") or []),
+                    "outputs": action.get("outputs") or {},
+                }
+            }
+        for expanded_name in expanded:
+            if expanded_name in actions:
+                raise ValueError(f"Action {expanded_name} is defined more than once")
+        actions.update(expanded)
+    return actions
+
+
+def render_action(name, action):
+    lines = [f"  {name}:", f"    run: {action['run']}"]
+    if action["needs"]:
+        lines.append(f"    needs: [{', '.join(action['needs'])}]")
+    lines.append("    outputs:")
+    for level, outputs in action["outputs"].items():
+        lines.append(f"      {level}:")
+        lines += [f"        {key}: {path}" for key, path in outputs.items()]
+    return "\n".join(lines)
+
+
+def render_project(template_text):
+    """Return the text of project.yaml for a project template: each template
+    action is replaced by its expansion, and everything else, comments
+    included, is kept as it is."""
+    import yaml
+
+    # Split the lines into action blocks (lists of lines) and other lines
+    chunks = []
+    block = None
+    blank_lines = []
+    in_actions = False
+    for line in template_text.split("\n"):
+        if not line.strip():
+            blank_lines.append(line)
+        elif in_actions and re.match(r"  \S.*:\s*$", line):
+            chunks += blank_lines
+            blank_lines = []
+            block = [line]
+            chunks.append(block)
+        elif block is not None and line.startswith("   "):
+            block += blank_lines + [line]
+            blank_lines = []
+        else:
+            chunks += blank_lines + [line]
+            blank_lines = []
+            block = None
+            in_actions = in_actions or line.rstrip() == "actions:"
+    chunks += blank_lines
+
+    lines = []
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            lines.append(chunk)
+            continue
+        [(name, action)] = yaml.safe_load("\n".join(chunk)).items()
+        if "matrix" not in action:
+            lines += chunk
+            continue
+        lines.append(
+            "\n\n".join(
+                render_action(expanded_name, expanded_action)
+                for expanded_name, expanded_action in expand_template(
+                    name, action
+                ).items()
+            )
+        )
+    return GENERATED_HEADER + "\n".join(lines)
+
+
+def expand_project(template_path=TEMPLATE_FILE, project_path=PROJECT_FILE):
+    with open(template_path) as f:
+        text = render_project(f.read())
+    with open(project_path, "w") as f:
+        f.write(text)
+    print(f"{project_path} written from {template_path}")
+
+
+def project_is_current(template_path=TEMPLATE_FILE, project_path=PROJECT_FILE):
+    try:
+        with open(template_path) as f, open(project_path) as g:
+            return render_project(f.read()) == g.read()
+    except FileNotFoundError:
+        return False
+
+
+def topological_order(actions):
+    order = []
+    state = {}
+
+    def visit(name, path):
+        if state.get(name) == "done":
+            return
+        if state.get(name) == "visiting":
+            raise ValueError(f"Cycle in needs: {' -> '.join(path + [name])}")
+        state[name] = "visiting"
+        for need in actions[name]["needs"]:
+            visit(need, path + [name])
+        state[name] = "done"
+        order.append(name)
+
+    for name in actions:
+        visit(name, [])
+    return order
+
+
+def with_needs(actions, targets):
+    """The target actions plus everything they need, directly or not."""
+    selected = set()
+    stack = list(targets)
+    while stack:
+        name = stack.pop()
+        if name not in actions:
+            raise ValueError(f"Unknown action {name}")
+        if name not in selected:
+            selected.add(name)
+            stack.extend(actions[name]["needs"])
+    return {name: action for name, action in actions.items() if name in selected}
+
+
+def image(action):
+    return action["run"].split()[0].split(":")[0]
+
+
+def image_reference(action):
+    name, _, tag = action["run"].split()[0].partition(":")
+    return f"{IMAGE_REGISTRY}/{name}:{tag or 'latest'}"
+
+
+def image_digest(reference):
+    """The id of the local docker image for reference, or None if docker
+    or the image is not available."""
+    try:
+        result = subprocess.run(
+            ["docker", "image", "inspect", "--format", "{{.Id}}", reference],
+            capture_output=True,
+            text=True,
+        )
+    except OSError:
+        return None
+    return result.stdout.strip() if result.returncode == 0 else None
+
+
+def critical_path(actions, durations):
+    """Return (total seconds, [actions]) of the longest chain of needs."""
+    finish = {}
+    previous = {}
+    for name in topological_order(actions):
+        needs = actions[name]["needs"]
+        slowest = max(needs, key=finish.get, default=None)
+        previous[name] = slowest
+        finish[name] = durations.get(name, 0) + (finish[slowest] if slowest else 0)
+    name = max(finish, key=finish.get, default=None)
+    total = finish.get(name, 0)
+    path = []
+    while name is not None:
+        path.append(name)
+        name = previous[name]
+    return total, path[::-1]
+
+
+def remaining_chain(actions, durations):
+    """For each action, the run time of the longest chain starting there."""
+    dependents = {name: [] for name in actions}
+    for name, action in actions.items():
+        for need in action["needs"]:
+            dependents[need].append(name)
+    chain = {}
+    for name in reversed(topological_order(actions)):
+        chain[name] = durations.get(name, 1) + max(
+            (chain[d] for d in dependents[name]), default=0
+        )
+    return chain, dependents
+
+
+def file_sha(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def copy_atomic(source, destination):
+    tmp_path = f"{destination}.{os.getpid()}.tmp"
+    shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, destination)
+
+
+def input_files(action):
+    args = shlex.split(action["run"])
+    files = [arg for arg in args[1:] if os.path.isfile(arg)]
+    if "--study-definition" in args:
+        study_name = args[args.index("--study-definition") + 1]
+        files.append(os.path.join("analysis", f"{study_name}.py"))
+    for pattern in IMAGE_INPUTS.get(image(action), []):
+        files += glob.glob(pattern)
+    return sorted(set(files))
+
+
+def output_files(action):
+    return sorted(
+        {path for pattern in action["outputs"] for path in glob.glob(pattern)}
+    )
+
+
+class ActionCache:
+    """Outputs of earlier runs, stored by content hash under a key hashed
+    from everything that can change them."""
+
+    def __init__(self, path):
+        self.objects = os.path.join(path, "objects")
+        self.entries = os.path.join(path, "actions")
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.entries, exist_ok=True)
+        self.image_digests = {}
+
+    def object_path(self, sha):
+        return os.path.join(self.objects, sha)
+
+    def entry_path(self, key):
+        return os.path.join(self.entries, f"{key}.json")
+
+    def key(self, action, need_outputs):
+        """Hash the run: line, the digest of its image, the files it reads
+        and the {path: sha} of the outputs of each action it needs, or
+        return None if the image digest is unknown."""
+        reference = image_reference(action)
+        if reference not in self.image_digests:
+            self.image_digests[reference] = image_digest(reference)
+            if self.image_digests[reference] is None:
+                print(
+                    f"Warning: no digest for {reference}; its actions are "
+                    "run without the cache",
+                    file=sys.stderr,
+                )
+        if self.image_digests[reference] is None:
+            return None
+        digest = hashlib.sha256(action["run"].encode())
+        digest.update(f"\0{self.image_digests[reference]}".encode())
+        for path in input_files(action):
+            digest.update(f"\0{path}\0{file_sha(path)}".encode())
+        for outputs in need_outputs:
+            for path, sha in sorted(outputs.items()):
+                digest.update(f"\0{path}\0{sha}".encode())
+        return digest.hexdigest()
+
+    def restore(self, key):
+        """Put back the outputs stored under key, returning their
+        {path: sha}, or None if there is nothing (complete) to restore."""
+        try:
+            with open(self.entry_path(key)) as f:
+                outputs = json.load(f)["outputs"]
+        except FileNotFoundError:
+            return None
+        if not all(os.path.exists(self.object_path(sha)) for sha in outputs.values()):
+            return None
+        for path, sha in outputs.items():
+            if not os.path.exists(path) or file_sha(path) != sha:
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                copy_atomic(self.object_path(sha), path)
+        return outputs
+
+    def store(self, key, action):
+        """Store the outputs of an action that has just run under key."""
+        outputs = {path: file_sha(path) for path in output_files(action)}
+        for path, sha in outputs.items():
+            if not os.path.exists(self.object_path(sha)):
+                copy_atomic(path, self.object_path(sha))
+        tmp_path = f"{self.entry_path(key)}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"run": action["run"], "outputs": outputs}, f, indent=2)
+        os.replace(tmp_path, self.entry_path(key))
+        return outputs
+
+
+def run_action(name, action, exec_command, log_dir):
+    command = shlex.split(exec_command) + shlex.split(action["run"])
+    start = time.perf_counter()
+    with open(os.path.join(log_dir, f"{name}.log"), "w") as log:
+        log.write(f"$ {shlex.join(command)}\n")
+        log.flush()
+        try:
+            returncode = subprocess.run(
+                command, stdout=log, stderr=subprocess.STDOUT
+            ).returncode
+        except OSError as e:
+            log.write(f"{e}\n")
+            returncode = 127
+    return returncode, time.perf_counter() - start
+
+
+def make_runner(exec_command, cache):
+    """Return run(name, action) -> (status, seconds), where status is ok,
+    failed or cached."""
+    output_hashes = {}
+
+    def run(name, action):
+        if cache is None:
+            returncode, seconds = run_action(name, action, exec_command, LOG_DIR)
+            return ("ok" if returncode == 0 else "failed"), seconds
+
+        key = cache.key(action, [output_hashes[need] for need in action["needs"]])
+        outputs = cache.restore(key) if key else None
+        if outputs is not None:
+            output_hashes[name] = outputs
+            return "cached", 0.0
+        returncode, seconds = run_action(name, action, exec_command, LOG_DIR)
+        if returncode != 0:
+            return "failed", seconds
+        if key:
+            output_hashes[name] = cache.store(key, action)
+        else:
+            output_hashes[name] = {
+                path: file_sha(path) for path in output_files(action)
+            }
+        return "ok", seconds
+
+    return run
+
+
+def execute(actions, workers, limits, run, durations):
+    """Run the actions with run(name, action) -> (status, seconds) and
+    return {name: {"status": ..., "seconds": ...}}."""
+    chain, dependents = remaining_chain(actions, durations)
+    waiting_on = {name: set(action["needs"]) for name, action in actions.items()}
+    ready = [name for name in actions if not waiting_on[name]]
+    running = {}
+    running_images = Counter()
+    results = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while ready or running:
+            ready.sort(key=lambda name: -chain[name])
+            for name in list(ready):
+                if len(running) >= workers:
+                    break
+                action_image = image(actions[name])
+                if running_images[action_image] >= limits.get(action_image, workers):
+                    continue
+                ready.remove(name)
+                running_images[action_image] += 1
+                running[pool.submit(run, name, actions[name])] = name
+                print(f"started  {name}", flush=True)
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                running_images[image(actions[name])] -= 1
+                status, seconds = future.result()
+                results[name] = {"status": status, "seconds": round(seconds, 1)}
+                print(f"{status:<8} {name} ({seconds:.0f}s)", flush=True)
+                if status == "failed":
+                    continue
+                for dependent in dependents[name]:
+                    waiting_on[dependent].discard(name)
+                    if not waiting_on[dependent]:
+                        ready.append(dependent)
+
+    for name in actions:
+        results.setdefault(name, {"status": "skipped", "seconds": None})
+    return results
+
+
+def parse_limits(values):
+    limits = {}
+    for value in values:
+        name, _, count = value.partition("=")
+        if not count.isdigit() or int(count) < 1:
+            raise ValueError(f"Invalid --limit {value}, expected IMAGE=N with N >= 1")
+        limits[name] = int(count)
+    return limits
+
+
+def load_timings():
+    try:
+        with open(TIMINGS_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_timings(timings):
+    with open(TIMINGS_FILE, "w") as f:
+        json.dump(timings, f, indent=2, sort_keys=True)
+
+
+def print_critical_path(actions, durations, label):
+    total, path = critical_path(actions, durations)
+    print(f"{label}: {total:.0f}s over {len(path)} actions")
+    for name in path:
+        print(f"    {name:<30} {durations.get(name, 0):>8.0f}s")
+
+
+def main(targets, workers, limits, exec_command, dry_run, use_cache):
+    if os.path.exists(TEMPLATE_FILE):
+        actions = load_actions(TEMPLATE_FILE)
+        if not project_is_current():
+            print(
+                f"Warning: {PROJECT_FILE} is out of date with {TEMPLATE_FILE}; "
+                "regenerate it with --expand",
+                file=sys.stderr,
+            )
+    else:
+        actions = load_actions(PROJECT_FILE)
+    if targets:
+        actions = with_needs(actions, targets)
+    timings = load_timings()
+
+    if dry_run:
+        # Actions that have not been run yet count as one second
+        estimates = {name: timings.get(name, 1) for name in actions}
+        print(f"{len(actions)} actions")
+        print_critical_path(
+            actions, estimates, "Critical path (from last recorded run times)"
+        )
+        return 0
+
+    os.makedirs(LOG_DIR, exist_ok=True)
+    cache = ActionCache(CACHE_DIR) if use_cache else None
+    start = time.perf_counter()
+    results = execute(
+        actions, workers, limits, make_runner(exec_command, cache), timings
+    )
+    wall_time = time.perf_counter() - start
+
+    run_times = {
+        name: result["seconds"]
+        for name, result in results.items()
+        if result["status"] == "ok"
+    }
+    timings = {**timings, **run_times}
+    save_timings(timings)
+
+    cached = sum(result["status"] == "cached" for result in results.values())
+    print(
+        f"Wall time: {wall_time:.0f}s, total action time: "
+        f"{sum(run_times.values()):.0f}s, {cached} actions restored from cache"
+    )
+    print_critical_path(
+        actions,
+        {name: timings.get(name, 0) for name in actions},
+        "Critical path (from recorded run times)",
+    )
+    unfinished = {
+        status: [name for name, result in results.items() if result["status"] == status]
+        for status in ("failed", "skipped")
+    }
+    for status, names in unfinished.items():
+        if names:
+            print(f"{status.capitalize()}: {', '.join(names)}")
+    return 1 if unfinished["failed"] or unfinished["skipped"] else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("actions", nargs="*")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument(
+        "--limit",
+        action="append",
+        default=[],
+        metavar="IMAGE=N",
+        help="run at most N actions using IMAGE at once",
+    )
+    parser.add_argument(
+        "--exec",
+        dest="exec_command",
+        default="opensafely exec",
+        help="command that runs an action's run: line",
+    )
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument(
+        "--expand",
+        action="store_true",
+        help=f"write {PROJECT_FILE} from {TEMPLATE_FILE} and exit",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="run every action, ignoring the cache"
+    )
+    args = parser.parse_args()
+    try:
+        if args.expand:
+            expand_project()
+            sys.exit(0)
+        sys.exit(
+            main(
+                args.actions,
+                args.workers,
+                parse_limits(args.limit),
+                args.exec_command,
+                args.dry_run,
+                not args.no_cache,
+            )
+        )
+    except ValueError as e:
+        sys.exit(str(e))
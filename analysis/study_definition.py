@@ -11,8 +11,53 @@ from cohortextractor import (
 )
 
 # IMPORT CODELIST DEFINITIONS FROM CODELIST.PY (WHICH PULLS THEM FROM
-# CODELIST FOLDER
-from codelists import *
+# CODELIST FOLDER). ONLY THE CODELISTS IMPORTED HERE ARE READ IN.
+from codelists import (
+    covid_codelist,
+    clear_smoking_codes,
+    ethnicity_codes_16,
+    systolic_blood_pressure_codes,
+    diastolic_blood_pressure_codes,
+    creatinine_codes,
+    hba1c_new_codes,
+    hba1c_old_codes,
+    asthma_codes,
+    pred_codes,
+    cf_codes,
+    other_respiratory_codes,
+    chronic_cardiac_disease_codes,
+    diabetes_codes,
+    hypertension_codes,
+    af_codes,
+    dvt_pe_codes,
+    pad_surg_codes,
+    amputate_codes,
+    stroke,
+    dementia,
+    other_neuro,
+    tia,
+    lung_cancer_codes,
+    haem_cancer_codes,
+    other_cancer_codes,
+    chronic_liver_disease_codes,
+    transplant_kidney_codes,
+    transplant_notkidney_codes,
+    dialysis_codes,
+    hiv_codes,
+    aplastic_codes,
+    temp_immune_codes,
+    permanent_immune_codes,
+    spleen_codes,
+    sickle_cell_codes,
+    ra_sle_psoriasis_codes,
+    inflammatory_bowel_disease_codes,
+    fracture_codes,
+    smi_codes,
+    ldr_codes,
+    ld_profound_codes,
+    ds_codes,
+    cp_codes,
+)
 
 
 #########################
@@ -206,17 +251,6 @@ study = StudyDefinition(
     ),
     # ETHNICITY
     # https://github.com/ebmdatalab/tpp-sql-notebook/issues/27
-    ethnicity=patients.with_these_clinical_events(
-        ethnicity_codes,
-        returning="category",
-        find_last_match_in_period=True,
-        on_or_before="index_date",
-        include_date_of_match=True,
-        return_expectations={
-            "category": {"ratios": {"1": 0.2, "2": 0.2, "3": 0.2, "4": 0.2, "5": 0.2,}},
-            "incidence": 0.75,
-        },
-    ),
     ethnicity_16=patients.with_these_clinical_events(
         ethnicity_codes_16,
         returning="category",
@@ -228,6 +262,29 @@ study = StudyDefinition(
             "incidence": 0.75,
         },
     ),
+    # 6 category ethnicity is a grouping of the 16 categories, so derive it
+    # from ethnicity_16 rather than scanning the ethnicity codes again
+    ethnicity=patients.categorised_as(
+        {
+            "0": "DEFAULT",
+            "1": "ethnicity_16 = '1' OR ethnicity_16 = '2' OR ethnicity_16 = '3'",
+            "2": """
+                ethnicity_16 = '4' OR ethnicity_16 = '5' OR
+                ethnicity_16 = '6' OR ethnicity_16 = '7'
+            """,
+            "3": """
+                ethnicity_16 = '8' OR ethnicity_16 = '9' OR
+                ethnicity_16 = '10' OR ethnicity_16 = '11'
+            """,
+            "4": "ethnicity_16 = '12' OR ethnicity_16 = '13' OR ethnicity_16 = '14'",
+            "5": "ethnicity_16 = '15' OR ethnicity_16 = '16'",
+        },
+        return_expectations={
+            "category": {
+                "ratios": {"0": 0.25, "1": 0.15, "2": 0.15, "3": 0.15, "4": 0.15, "5": 0.15}
+            },
+        },
+    ),
     # SMOKING STATUS
     # https://github.com/ebmdatalab/tpp-sql-notebook/issues/6
     smoking_status=patients.categorised_as(
@@ -391,23 +448,22 @@ study = StudyDefinition(
             returning="number_of_matches_in_period",
         ),
     ),
-    ### COMORBIDITIES - FIRST DIAGNOSIS DATE
+    ### COMORBIDITIES - EVER RECORDED (BINARY FLAG), OR DATE WHERE THE
+    ### TIMING IS NEEDED (CANCER, DIALYSIS, KIDNEY TRANSPLANT, IMMUNOSUPPRESSION)
     # RESPIRATORY - ASTHMA, CYSTIC FIBROSIS, OTHER (largely COPD)
     # https://github.com/ebmdatalab/tpp-sql-notebook/issues/55
     cf=patients.with_these_clinical_events(
         cf_codes,
-        return_first_date_in_period=True,
+        returning="binary_flag",
         on_or_before="index_date - 1 day",
-        include_month=True,
         return_expectations={
             "incidence": 0.2,
         },
     ),
     respiratory=patients.with_these_clinical_events(
         other_respiratory_codes,
-        return_first_date_in_period=True,
+        returning="binary_flag",
         on_or_before="index_date - 1 day",
-        include_month=True,
         return_expectations={
             "incidence": 0.2,
         },
@@ -416,9 +472,8 @@ study = StudyDefinition(
     # https://github.com/ebmdatalab/tpp-sql-notebook/issues/7
     cardiac=patients.with_these_clinical_events(
         chronic_cardiac_disease_codes,
-        return_first_date_in_period=True,
+        returning="binary_flag",
         on_or_before="index_date - 1 day",
-        include_month=True,
         return_expectations={
             "incidence": 0.2,
         },
@@ -426,9 +481,8 @@ study = StudyDefinition(
     # ATRIAL FIBRILLATION
     af=patients.with_these_clinical_events(
         af_codes,
-        return_first_date_in_period=True,
+        returning="binary_flag",
         on_or_before="index_date - 1 day",
-        include_month=True,
         return_expectations={
             "incidence": 0.2,
         },
@@ -437,9 +491,8 @@ study = StudyDefinition(
     # Deep vein thrombosis / pulmonary embolism
     dvt_pe=patients.with_these_clinical_events(
             dvt_pe_codes,
-            return_first_date_in_period=True,
+            returning="binary_flag",
             on_or_before="index_date - 1 day",
-            include_month=True,
         return_expectations={
             "incidence": 0.2,
         },
@@ -447,9 +500,8 @@ study = StudyDefinition(
     # PAD surgery
     pad_surg=patients.with_these_clinical_events(
         pad_surg_codes,
-        return_first_date_in_period=True,
+        returning="binary_flag",
         on_or_before="index_date - 1 day",
-        include_month=True,
         return_expectations={
             "incidence": 0.2,
         },
@@ -457,9 +509,8 @@ study = StudyDefinition(
     # Amputation (limb)
     amputate=patients.with_these_clinical_events(
         amputate_codes,
-        return_first_date_in_period=True,
+        returning="binary_flag",
         on_or_before="index_date - 1 day",
-        include_month=True,
         return_expectations={
             "incidence": 0.2,
         },
@@ -470,8 +521,7 @@ study = StudyDefinition(
     diabetes=patients.with_these_clinical_events(
         diabetes_codes,
         on_or_before="index_date - 1 day",
-        return_first_date_in_period=True,
-        include_month=True,
+        returning="binary_flag",
         return_expectations={
             "incidence": 0.2,
         },
@@ -480,9 +530,8 @@ study = StudyDefinition(
     # https://github.com/ebmdatalab/tpp-sql-notebook/issues/23
     hypertension=patients.with_these_clinical_events(
         hypertension_codes,
-        return_first_date_in_period=True,
+        returning="binary_flag",
         on_or_before="index_date - 1 day",
-        include_month=True,
         return_expectations={
             "incidence": 0.2,
         },
@@ -490,18 +539,16 @@ study = StudyDefinition(
     # STROKE, DEMENTIA, OTHER NEUROLOGICAL
     stroke=patients.with_these_clinical_events(
         stroke,
-        return_first_date_in_period=True,
+        returning="binary_flag",
         on_or_before="index_date - 1 day",
-        include_month=True,
         return_expectations={
             "incidence": 0.2,
         },
     ),
     dementia=patients.with_these_clinical_events(
         dementia,
-        return_first_date_in_period=True,
+        returning="binary_flag",
         on_or_before="index_date - 1 day",
-        include_month=True,
         return_expectations={
             "incidence": 0.2,
         },
@@ -509,18 +556,16 @@ study = StudyDefinition(
     # https://github.com/ebmdatalab/tpp-sql-notebook/issues/14
     neuro=patients.with_these_clinical_events(
         other_neuro,
-        return_first_date_in_period=True,
+        returning="binary_flag",
         on_or_before="index_date - 1 day",
-        include_month=True,
         return_expectations={
             "incidence": 0.2,
         },
     ),
     tia=patients.with_these_clinical_events(
             tia,
-            return_first_date_in_period=True,
+            returning="binary_flag",
             on_or_before="index_date - 1 day",
-            include_month=True,
         return_expectations={
             "incidence": 0.2,
         },
@@ -578,18 +623,16 @@ study = StudyDefinition(
     # https://github.com/ebmdatalab/tpp-sql-notebook/issues/12
     liver=patients.with_these_clinical_events(
         chronic_liver_disease_codes,
-        return_first_date_in_period=True,
+        returning="binary_flag",
         on_or_before="index_date - 1 day",
-        include_month=True,
         return_expectations={
             "incidence": 0.2,
         },
     ),
     transplant_notkidney=patients.with_these_clinical_events(
         transplant_notkidney_codes,
-        return_first_date_in_period=True,
+        returning="binary_flag",
         on_or_before="2020-02-29",
-        include_month=True,
         return_expectations={
             "incidence": 0.2,
         },
@@ -598,36 +641,32 @@ study = StudyDefinition(
     # https://github.com/ebmdatalab/tpp-sql-notebook/issues/13
     dysplenia=patients.with_these_clinical_events(
         spleen_codes,
-        return_first_date_in_period=True,
+        returning="binary_flag",
         on_or_before="index_date - 1 day",
-        include_month=True,
         return_expectations={
             "incidence": 0.2,
         },
     ),
     sickle_cell=patients.with_these_clinical_events(
         sickle_cell_codes,
-        return_first_date_in_period=True,
+        returning="binary_flag",
         on_or_before="index_date - 1 day",
-        include_month=True,
         return_expectations={
             "incidence": 0.2,
         },
     ),
     hiv=patients.with_these_clinical_events(
         hiv_codes,
-        return_first_date_in_period=True,
+        returning="binary_flag",
         on_or_before="index_date - 1 day",
-        include_month=True,
         return_expectations={
             "incidence": 0.2,
         },
     ),
     perm_immuno=patients.with_these_clinical_events(
         permanent_immune_codes,
-        return_first_date_in_period=True,
+        returning="binary_flag",
         on_or_before="index_date - 1 day",
-        include_month=True,
         return_expectations={
             "incidence": 0.2,
         },
@@ -656,9 +695,8 @@ study = StudyDefinition(
     # # https://github.com/ebmdatalab/tpp-sql-notebook/issues/49
     autoimmune=patients.with_these_clinical_events(
         ra_sle_psoriasis_codes,
-        return_first_date_in_period=True,
+        returning="binary_flag",
         on_or_before="index_date - 1 day",
-        include_month=True,
         return_expectations={
             "incidence": 0.2,
         },
@@ -667,9 +705,8 @@ study = StudyDefinition(
     # https://github.com/ebmdatalab/tpp-sql-notebook/issues/50
     ibd=patients.with_these_clinical_events(
         inflammatory_bowel_disease_codes,
-        return_first_date_in_period=True,
+        returning="binary_flag",
         on_or_before="index_date - 1 day",
-        include_month=True,
         return_expectations={
             "incidence": 0.2,
         },
@@ -677,9 +714,8 @@ study = StudyDefinition(
     # Severe Mental Illness
     smi=patients.with_these_clinical_events(
         smi_codes,
-        return_first_date_in_period=True,
+        returning="binary_flag",
         on_or_before="index_date - 1 day",
-        include_month=True,
         return_expectations={
             "incidence": 0.2,
         },
@@ -687,9 +723,8 @@ study = StudyDefinition(
     # Fragility fracture in two years
     fracture=patients.with_these_clinical_events(
         fracture_codes,
-        return_last_date_in_period=True,
+        returning="binary_flag",
         between=["index_date - 2 years", "index_date"],
-        include_month=True,
         return_expectations={
             "incidence": 0.2,
         },
@@ -702,18 +737,16 @@ study = StudyDefinition(
     # Learning disability (excluding Down's Syndrome)
     ldr=patients.with_these_clinical_events(
         ldr_codes,
-        return_first_date_in_period=True,
+        returning="binary_flag",
         on_or_before="index_date - 1 day",
-        include_month=True,
         return_expectations={
             "incidence": 0.4,
         },
     ),
     ld_profound=patients.with_these_clinical_events(
         ld_profound_codes,
-        return_first_date_in_period=True,
+        returning="binary_flag",
         on_or_before="index_date - 1 day",
-        include_month=True,
         return_expectations={
             "incidence": 0.2,
         },
@@ -721,9 +754,8 @@ study = StudyDefinition(
     # Down's Syndrome
     ds=patients.with_these_clinical_events(
         ds_codes,
-        return_first_date_in_period=True,
+        returning="binary_flag",
         on_or_before="index_date - 1 day",
-        include_month=True,
         return_expectations={
             "incidence": 0.2,
         },
@@ -731,9 +763,8 @@ study = StudyDefinition(
     # Cerebral Palsy
     cp=patients.with_these_clinical_events(
         cp_codes,
-        return_first_date_in_period=True,
+        returning="binary_flag",
         on_or_before="index_date - 1 day",
-        include_month=True,
         return_expectations={
             "incidence": 0.2,
         },
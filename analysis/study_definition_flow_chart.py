@@ -11,8 +11,10 @@ from cohortextractor import (
 )
 
 # IMPORT CODELIST DEFINITIONS FROM CODELIST.PY (WHICH PULLS THEM FROM
-# CODELIST FOLDER
-from codelists import *
+# CODELIST FOLDER). ONLY THE CODELISTS IMPORTED HERE ARE READ IN.
+from codelists import (
+    ethnicity_codes,
+)
 
 
 #########################
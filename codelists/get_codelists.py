@@ -1,26 +1,177 @@
+"""Download the codelists listed in codelists.txt.
+
+Codelists whose csv already matches the version and SHA recorded in
+codelists.json are skipped; the rest are fetched concurrently over a pooled
+session with retries, and each csv is written to a temporary file and renamed
+into place, so a failed run never leaves a partial or missing csv behind.
+codelists.json is updated for every codelist that is downloaded.
+
+    python codelists/get_codelists.py [--workers N] [--mirror DIR]
+
+With --mirror the csvs are copied from a local directory laid out like the
+codelists site, i.e. DIR/<project>/<codelist>/<version>/download.csv, so the
+whole flow can be run offline.
+"""
+import argparse
+import datetime
 import glob
+import hashlib
+import json
 import os
-import requests
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+base_path = os.path.dirname(os.path.abspath(__file__))
+base_url = "https://codelists.opensafely.org/codelist"
+
+# os.umask can only be read by setting it, so do that once, before any
+# download threads start
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def read_codelist_ids():
+    with open(os.path.join(base_path, "codelists.txt")) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def read_manifest():
+    try:
+        with open(os.path.join(base_path, "codelists.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"files": {}}
+
+
+def csv_filename(codelist_id):
+    project_id, codelist_name, version = codelist_id.split("/")
+    return f"{project_id}-{codelist_name}.csv"
+
+
+def file_sha(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def is_up_to_date(codelist_id, manifest):
+    filename = csv_filename(codelist_id)
+    entry = manifest["files"].get(filename)
+    path = os.path.join(base_path, filename)
+    if entry is None or entry["id"] != codelist_id or not os.path.exists(path):
+        return False
+    return file_sha(path) == entry["sha"]
+
+
+def file_mode(path):
+    """The mode a rewritten file should have: its current mode if it
+    exists, otherwise what a plain open() would give it."""
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        return 0o666 & ~UMASK
+
+
+def write_atomic(path, content):
+    # mkstemp creates the file as 0600, which the rename would keep
+    mode = file_mode(path)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def make_session(workers):
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retries = Retry(
+        total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]
+    )
+    adapter = HTTPAdapter(
+        max_retries=retries, pool_connections=1, pool_maxsize=workers
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def fetch(codelist_id, session, mirror):
+    if mirror is not None:
+        with open(os.path.join(mirror, codelist_id, "download.csv"), "rb") as f:
+            return f.read()
+
+    rsp = session.get(f"{base_url}/{codelist_id}/download.csv", timeout=60)
+    rsp.raise_for_status()
+    return rsp.content
+
+
+def download(codelist_id, session, mirror):
+    content = fetch(codelist_id, session, mirror)
+    write_atomic(os.path.join(base_path, csv_filename(codelist_id)), content)
+    return {
+        "id": codelist_id,
+        "url": f"{base_url}/{codelist_id}/",
+        "downloaded_at": f"{datetime.datetime.utcnow()}Z",
+        "sha": hashlib.sha1(content).hexdigest(),
+    }
 
 
-base_path = os.path.dirname(__file__)
+def main(workers, mirror):
+    codelist_ids = read_codelist_ids()
+    manifest = read_manifest()
 
-for path in glob.glob(os.path.join(base_path, "*.csv")):
-    os.unlink(path)
+    to_fetch = [cid for cid in codelist_ids if not is_up_to_date(cid, manifest)]
+    print(f"{len(codelist_ids) - len(to_fetch)} codelists up to date")
 
+    session = make_session(workers) if mirror is None and to_fetch else None
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(download, cid, session, mirror): cid for cid in to_fetch
+        }
+        for future in as_completed(futures):
+            codelist_id = futures[future]
+            try:
+                manifest["files"][csv_filename(codelist_id)] = future.result()
+            except Exception as e:
+                print(f"FAILED {codelist_id}: {e}")
+                failed.append(codelist_id)
+            else:
+                print(codelist_id)
 
-with open(os.path.join(base_path, "codelists.txt")) as f:
-    for line in f:
-        line = line.strip()
-        if not line:
-            continue
+    # Only tidy up csvs for codelists no longer listed once everything is in
+    if not failed:
+        wanted = {csv_filename(cid) for cid in codelist_ids}
+        for path in glob.glob(os.path.join(base_path, "*.csv")):
+            if os.path.basename(path) not in wanted:
+                os.unlink(path)
+        manifest["files"] = {
+            filename: entry
+            for filename, entry in sorted(manifest["files"].items())
+            if filename in wanted
+        }
 
-        print(line)
-        project_id, codelist_id, version = line.split("/")
-        url = f"https://codelists.opensafely.org/codelist/{project_id}/{codelist_id}/{version}/download.csv"
+    write_atomic(
+        os.path.join(base_path, "codelists.json"),
+        json.dumps(manifest, indent=2).encode("utf8"),
+    )
+    return 1 if failed else 0
 
-        rsp = requests.get(url)
-        rsp.raise_for_status()
 
-        with open(os.path.join(base_path, f"{project_id}-{codelist_id}.csv"), "w") as f:
-            f.write(rsp.text)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument(
+        "--mirror", help="local directory to copy codelists from, for offline use"
+    )
+    args = parser.parse_args()
+    sys.exit(main(args.workers, args.mirror))